@@ -1,19 +1,19 @@
 from gpu_module import GpuModule
 from db_prometheus import DataBaseProm
-import time
 import signal
 import os
 import logging
+import threading
 
 
 class GracefulKiller:
     def __init__(self):
-        self.kill_now = False
+        self.event = threading.Event()
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
 
     def exit_gracefully(self, *args):
-        self.kill_now = True
+        self.event.set()
 
 
 if __name__ == "__main__":
@@ -24,8 +24,10 @@ if __name__ == "__main__":
     metric_port = 9001
 
     log_parsing_period = float(os.getenv("LOG_PARSING_PERIOD", "2"))
+    num_cpus = int(os.getenv("NUM_CPUS", "0")) or os.cpu_count()
+    num_gpcs = int(os.getenv("NUM_GPCS", "1"))
 
-    db = DataBaseProm(metric_port)
+    db = DataBaseProm(metric_port, num_cpus, num_gpcs)
     gpu_module = GpuModule(db, log_parsing_period)
     gpu_module.run(async_mode=True)
 
@@ -35,10 +37,8 @@ if __name__ == "__main__":
         f"(log parsing period = {log_parsing_period}s)"
     )
 
-    while not killer.kill_now:
-        time.sleep(1)
+    killer.event.wait()
 
     logging.info("Jetson GPU Exporter shutting down...")
-    p = gpu_module.tegrastats_subprocess
-    if p:
-        os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+    gpu_module.stop()
+    gpu_module.td.join(timeout=5)
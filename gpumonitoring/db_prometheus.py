@@ -24,12 +24,36 @@ Prometheus as database
 Instrumenting message to Prometheus metrics and push to a remote endpoint
 """
 
-from prometheus_client import Gauge, start_http_server, REGISTRY
-from threading import Lock
+from prometheus_client import (
+    CollectorRegistry,
+    GCCollector,
+    Gauge,
+    PlatformCollector,
+    ProcessCollector,
+    start_http_server,
+)
+from threading import Event, Lock, Thread
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+HELP_TEXT = {
+    "tegrastats_gpu_util": "GPU Utilization (%)",
+    "tegrastats_gpu_freq": "GPU Frequency (Hz)",
+    "tegrastats_gpu_temp": "GPU Temperature (°C)",
+    "tegrastats_cpu_temp": "CPU Temperature (°C)",
+    "tegrastats_cpu_usage": "CPU Core Utilization (%)",
+    "tegrastats_ram_usage": "RAM Usage (MB)",
+    "tegrastats_emc_util": "EMC Memory BW Utilization (%)",
+    "tegrastats_emc_freq": "EMC Frequency (Hz)",
+    "tegrastats_nvenc_freq": "NVENC Frequency (Hz)",
+    "tegrastats_nvenc1_freq": "NVENC1 Frequency (Hz)",
+    "tegrastats_nvdec_freq": "NVDEC Frequency (Hz)",
+    "tegrastats_nvdec1_freq": "NVDEC1 Frequency (Hz)",
+    "tegrastats_per_process_gpu_mem": "Per-process GPU Memory (KB)",
+}
+
 
 class DataBaseProm:
     """
@@ -37,52 +61,124 @@ class DataBaseProm:
     Exposes metrics via /metrics endpoint instead of Pushgateway
     """
 
-    def __init__(self, metrics_port: int):
-        self._metrics_map = {}
-        self._metrics_map_lock = Lock()
+    def __init__(self, metrics_port: int, num_cpus: int = None, num_gpcs: int = 1):
+        # a private registry keeps scrapes off the global registry lock and away
+        # from whatever other libraries register there
+        self._registry = CollectorRegistry()
+        # keep the process_*/python_* series the default registry exported
+        ProcessCollector(registry=self._registry)
+        PlatformCollector(registry=self._registry)
+        GCCollector(registry=self._registry)
         self._labels_tegrastats = ["label", "index"]
+        self._metrics_map = {
+            metrics_name: Gauge(
+                metrics_name,
+                help_text,
+                self._labels_tegrastats,
+                registry=self._registry,
+            )
+            for metrics_name, help_text in HELP_TEXT.items()
+        }
+        # labelled children keyed by (metrics_name, label, index), the lock only
+        # guards insertion of a child seen for the first time
+        self._child_cache = {}
+        self._child_cache_lock = Lock()
+        # CPU cores and GPCs are fixed per SKU, their children are addressed by
+        # index and bound on the first real sample so that offline cores are
+        # never exported
+        self._cpu_children = [None] * (num_cpus or os.cpu_count() or 1)
+        self._gpu_freq_children = [None] * num_gpcs
+
+        self._healthy_gauge = Gauge(
+            "tegrastats_exporter_healthy",
+            "Whether the last tegrastats collection cycle succeeded",
+            registry=self._registry,
+        )
+
+        # child -> latest value, applied by a separate thread so that a scrape
+        # holding prometheus_client locks never stalls the parser; only the
+        # newest value per child is kept, so no series can be starved
+        self._pending = {}
+        self._pending_lock = Lock()
+        self._pending_event = Event()
+        self._applier = Thread(target=self._apply_forever, daemon=True)
+        self._applier.start()
 
         # Start Prometheus HTTP server
-        start_http_server(metrics_port)
+        start_http_server(metrics_port, registry=self._registry)
         logger.info(f"Prometheus exporter running on port {metrics_port}")
 
+    def _get_child(self, metrics_name, label, index):
+        key = (metrics_name, label, index)
+        child = self._child_cache.get(key)
+        if child is None:
+            gauge = self._metrics_map.get(metrics_name)
+            if gauge is None:
+                return None
+            with self._child_cache_lock:
+                child = self._child_cache.get(key)
+                if child is None:
+                    child = gauge.labels(label=label, index=index)
+                    self._child_cache[key] = child
+        return child
+
     def store(self, msg):
         """Store metrics for tegrastats data"""
         metrics_name = msg["key"].lower()
 
-        with self._metrics_map_lock:
-            # Initialize metric if not exists
-            if metrics_name not in self._metrics_map:
-                help_text = {
-                    "tegrastats_gpu_util": "GPU Utilization (%)",
-                    "tegrastats_gpu_freq": "GPU Frequency (Hz)",
-                    "tegrastats_gpu_temp": "GPU Temperature (°C)",
-                    "tegrastats_cpu_temp": "CPU Temperature (°C)",
-                    "tegrastats_cpu_usage": "CPU Core Utilization (%)",
-                    "tegrastats_ram_usage": "RAM Usage (MB)",
-                    "tegrastats_emc_util": "EMC Memory BW Utilization (%)",
-                    "tegrastats_emc_freq": "EMC Frequency (Hz)",
-                    "tegrastats_nvenc_freq": "NVENC Frequency (Hz)",
-                    "tegrastats_nvenc1_freq": "NVENC1 Frequency (Hz)",
-                    "tegrastats_nvdec_freq": "NVDEC Frequency (Hz)",
-                    "tegrastats_nvdec1_freq": "NVDEC1 Frequency (Hz)",
-                    "tegrastats_per_process_gpu_mem": "Per-process GPU Memory (KB)",
-                }.get(metrics_name, None)
-
-                if help_text is None:
-                    logger.warning(f"Unrecognized metric: {metrics_name}")
-                    return
-
-                gauge = Gauge(
-                    metrics_name, help_text, self._labels_tegrastats, registry=REGISTRY
+        metric = self._get_child(
+            metrics_name, msg.get("label", "none"), str(msg.get("index", "0"))
+        )
+        if metric is None:
+            logger.warning(f"Unrecognized metric: {metrics_name}")
+            return
+
+        self._enqueue(metrics_name, metric, msg["value"])
+
+    def _set_indexed(self, children, metrics_name, label, index, value):
+        if index < len(children):
+            metric = children[index]
+            if metric is None:
+                metric = children[index] = self._get_child(
+                    metrics_name, label, str(index)
                 )
-                self._metrics_map[metrics_name] = gauge
+        else:
+            metric = self._get_child(metrics_name, label, str(index))
+        self._enqueue(metrics_name, metric, value)
 
-            # Set metric value
-            metric = self._metrics_map[metrics_name].labels(
-                label=msg.get("label", "none"), index=msg.get("index", "0")
-            )
-            try:
-                metric.set(float(msg["value"]))
-            except Exception:
-                logger.warning(f"Invalid value for {metrics_name}: {msg['value']}")
+    def _enqueue(self, metrics_name, metric, value):
+        try:
+            # values parsed by GpuModule are already numeric
+            if not isinstance(value, (int, float)):
+                value = float(value)
+        except Exception:
+            logger.warning(f"Invalid value for {metrics_name}: {value}")
+            return
+        with self._pending_lock:
+            self._pending[metric] = value
+        self._pending_event.set()
+
+    def _apply_forever(self):
+        while True:
+            self._pending_event.wait()
+            self._pending_event.clear()
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            for metric, value in pending.items():
+                metric.set(value)
+
+    def set_healthy(self, healthy):
+        """Flag whether the exporter is currently collecting successfully"""
+        self._healthy_gauge.set(1 if healthy else 0)
+
+    def set_cpu(self, index, value):
+        """Store the utilization of one CPU core"""
+        self._set_indexed(
+            self._cpu_children, "tegrastats_cpu_usage", "CPU", index, value
+        )
+
+    def set_gpu_freq(self, index, value):
+        """Store the frequency of one GPC"""
+        self._set_indexed(
+            self._gpu_freq_children, "tegrastats_gpu_freq", "GPU_FREQ", index, value
+        )
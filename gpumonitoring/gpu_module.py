@@ -21,250 +21,246 @@
 
 from datetime import datetime
 import threading
-import humps
 import logging
-import time
 import os
-import subprocess
-from collections import defaultdict
+import time
+import re
 import signal
+import subprocess
+from selectors import DefaultSelector, EVENT_READ
 
 
 GPU_SOURCE = "tegrastats"
+NVMAP_CLIENTS = "/sys/kernel/debug/nvmap/iovmm/clients"
+# parsing periods without a tegrastats line before the process is respawned
+TEGRASTATS_TIMEOUT_PERIODS = 3
+# seconds between attempts to reopen the clients file after a failure
+NVMAP_CLIENTS_RETRY_PERIOD = 60
+# one row of the nvmap clients table, header and total rows never match:
+#   user   process_name  process_id   mem_usage
+#   user   rosie-perceptio    27278     753528K
+NVMAP_CLIENTS_RE = re.compile(rb"\n\S+\s+(\S+)\s+\d+\s+(\d+)K")
+# single-pass tokenizer for a tegrastats line, the name of the last matched
+# group tells which entity was found
+TEGRA_STATS_RE = re.compile(
+    r"\bRAM (?P<ram>\d+)/\d+"
+    r"|CPU \[(?P<cpu>[^\]]+)\]"
+    r"|EMC_FREQ (?P<emc_util>\d+)%@(?P<emc_freq>\d+)"
+    r"|GR3D_FREQ (?P<gpu_util>\d+)%@\[?(?P<gpu_freq>[0-9,]+)\]?"
+    r"|(?P<nvkey>NVENC1?|NVDEC1?) (?:off|(?:\S*@)?(?P<nvval>\d+)(?!\S))"
+    r"|(?i:gpu)@(?P<gpu_temp>-?[0-9.]+)C"
+    r"|(?i:cpu)@(?P<cpu_temp>-?[0-9.]+)C"
+)
 logger = logging.getLogger(__name__)
 
 
-class GpuEvent:
-    def __init__(self, key, value, label, **kwargs):
-        self.timestamp = datetime.utcnow().isoformat()
-        self.module = GPU_SOURCE
-        self.object = GPU_SOURCE
-        self.source = GPU_SOURCE
-        self.key = key
-        self.value = value
-        self.label = label
-
-        for k, v in kwargs.items():
-            setattr(self, k, v)
-
-    def to_dict(self):
-        return humps.camelize(self.__dict__)
-
-
 class GpuModule:
     "GpuModule class that monitors gpu utilization through tegrastats"
 
+    # tegra stats key -> (metric name, metric key, db setter for per-index samples)
+    _DISPATCH = {
+        "GPU_UTIL": ("GPU_UTIL", "tegrastats_gpu_util", None),
+        "GPU_FREQ": ("GPU_FREQ", "tegrastats_gpu_freq", "set_gpu_freq"),
+        "GPU_TEMP": ("GPU_TEMP", "tegrastats_gpu_temp", None),
+        "CPU_TEMP": ("CPU_TEMP", "tegrastats_cpu_temp", None),
+        "CPU": ("CPU", "tegrastats_cpu_usage", "set_cpu"),
+        "RAM": ("RAM", "tegrastats_ram_usage", None),
+        "EMC_FREQ": ("EMC_FREQ", "tegrastats_emc_freq", None),
+        "EMC_UTIL": ("EMC_UTIL", "tegrastats_emc_util", None),
+        "NVENC": ("NVENC", "tegrastats_nvenc_freq", None),
+        "NVENC1": ("NVENC1", "tegrastats_nvenc1_freq", None),
+        "NVDEC": ("NVDEC", "tegrastats_nvdec_freq", None),
+        "NVDEC1": ("NVDEC1", "tegrastats_nvdec1_freq", None),
+    }
+
     def __init__(self, db, _log_parsing_period):
         self.db = db
         self.log_parsing_period = _log_parsing_period
-        self.metric_set = defaultdict(set)
+        self._healthy = False
+        self.db.set_healthy(self._healthy)
         self.tegra_stats = {}
+        # every event of a cycle shares the timestamp of its tegrastats sample
+        self._now_iso = datetime.utcnow().isoformat()
         self.per_process_gpu_usage = {}
         self.td = None
         self.tegrastats_subprocess = None
+        self._tegrastats_pending = b""
+        # the worker multiplexes tegrastats output and shutdown requests
+        self._shutdown_fd = os.eventfd(0)
+        self._selector = DefaultSelector()
+        self._selector.register(self._shutdown_fd, EVENT_READ)
+        self._nvmap_buf = bytearray(65536)
+        self._nvmap_warned = False
+        self._open_nvmap_clients()
 
     def store_gpu_event(
-        self, metric_value: str, metric_name: str, metric_key: str, **kwargs
+        self, metric_value: float, metric_name: str, metric_key: str, **kwargs
     ) -> None:
-        event = GpuEvent(metric_key, metric_value, metric_name, **kwargs)
-        self.db.store(event.to_dict())
-
-    def _nullify_gpu_data(self):
+        self.db.store(
+            {
+                "timestamp": self._now_iso,
+                "module": GPU_SOURCE,
+                "object": GPU_SOURCE,
+                "source": GPU_SOURCE,
+                "key": metric_key,
+                "value": metric_value,
+                "label": metric_name,
+                **kwargs,
+            }
+        )
+
+    def _set_healthy(self, healthy):
+        # only touch the gauge when the state flips
+        if healthy != self._healthy:
+            self._healthy = healthy
+            self.db.set_healthy(healthy)
+
+    def _open_nvmap_clients(self):
+        self._nvmap_retry_at = time.monotonic() + NVMAP_CLIENTS_RETRY_PERIOD
         try:
-            for metric_name, metric_keys in self.metric_set.items():
-                for metric_key in metric_keys:
-                    self.store_gpu_event(0.0, metric_name, metric_key)
-        except Exception:
-            logger.exception("Unable to nullify GPU data !!!")
+            self._nvmap_fd = os.open(NVMAP_CLIENTS, os.O_RDONLY)
+        except OSError as e:
+            self._nvmap_fd = None
+            if not self._nvmap_warned:
+                self._nvmap_warned = True
+                logger.warning(
+                    f"Unable to open {NVMAP_CLIENTS} ({e.strerror}), per process "
+                    "GPU usage is disabled until it becomes readable"
+                )
 
     def _get_per_process_gpu_stats(self):
-        script = "cat /sys/kernel/debug/nvmap/iovmm/clients"
-        self.per_process_usage = {}
+        self.per_process_usage = b""
+        if self._nvmap_fd is None:
+            if time.monotonic() < self._nvmap_retry_at:
+                return
+            self._open_nvmap_clients()
+            if self._nvmap_fd is None:
+                return
         try:
-            output = subprocess.run(
-                script.split(" "), stdout=subprocess.PIPE, timeout=1
-            )
-            self.per_process_usage = output.stdout.decode("utf-8").strip()
+            # read into the preallocated buffer, no bytes object per cycle; a
+            # full buffer may mean a truncated table, so grow it and re-read
+            n = os.preadv(self._nvmap_fd, [self._nvmap_buf], 0)
+            while n == len(self._nvmap_buf):
+                self._nvmap_buf = bytearray(2 * len(self._nvmap_buf))
+                n = os.preadv(self._nvmap_fd, [self._nvmap_buf], 0)
+            self.per_process_usage = memoryview(self._nvmap_buf)[:n]
         except Exception:
             raise Exception("Unable to get per process GPU usage  !")
 
     def _parse_per_process_gpu_stats(self):
-        process_mem_usage = {}
-        per_process_usage = self.per_process_usage.split("\n")[1:-1]
-        for process_info in per_process_usage:
-            process_info = process_info.split()
-            # sample prcess_info:
-            #   user   process_name  process_id   mem_usage
-            # ['user  rosie-perceptio    27278     753528K']
-            process_mem_usage[process_info[1]] = int(process_info[3][:-1])
-
-        self.per_process_usage = process_mem_usage
+        self.per_process_usage = {
+            m.group(1).decode(): int(m.group(2))
+            for m in NVMAP_CLIENTS_RE.finditer(self.per_process_usage)
+        }
 
-    def _get_tegra_stats(self):
-        script = "timeout 0.2 tegrastats --load_cfg ./tstats.txt --interval 100"
-        self.tegra_stats = ""
+    def _start_tegrastats(self):
+        interval = max(int(self.log_parsing_period * 1000), 1)
+        script = "tegrastats --load_cfg ./tstats.txt --interval {}".format(interval)
 
         try:
-            # launch a process group so that all child processes get purged as well when the command
-            # times out due to high cpu usage
-            p = subprocess.Popen(
-                script.split(" "), stdout=subprocess.PIPE, preexec_fn=os.setsid
+            # launch a process group so that all child processes get purged as well
+            # when the exporter shuts down
+            self.tegrastats_subprocess = subprocess.Popen(
+                script.split(" "), stdout=subprocess.PIPE, start_new_session=True
             )
-            self.tegrastats_subprocess = p
-            output, _ = p.communicate(timeout=1)
         except Exception:
-            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+            self.tegrastats_subprocess = None
             raise Exception("Unable to call tegrastats utility !")
-        try:
-            self.tegra_stats = output.decode("utf-8").strip()
-            return self.tegra_stats
-        except Exception:
-            raise Exception("Unable to decode tegrastats output !")
-
-    def _parse_tegra_stats(self, tegra_stats_buffer, tegra_stats_iter):
-        entity = next(tegra_stats_iter, None)
-        if entity is None:
-            return entity
-
-        if entity == "RAM":
-            ram_info = next(tegra_stats_iter)
-            ram_info = ram_info.split("/")[0]
-            tegra_stats_buffer[entity] = ram_info
-
-        if entity == "CPU":
-            cpu_info = next(tegra_stats_iter)
-            cpu_info = cpu_info.replace("[", "").replace("]", "").split(",")
-            cpu_info = [e.split("%")[0] for e in cpu_info]
-            if entity not in tegra_stats_buffer.keys():
-                tegra_stats_buffer[entity] = cpu_info
+        self._tegrastats_pending = b""
+        self._selector.register(self.tegrastats_subprocess.stdout, EVENT_READ)
+
+    def _stop_tegrastats(self):
+        p = self.tegrastats_subprocess
+        if p is None:
+            return
+        self._selector.unregister(p.stdout)
+        if p.poll() is None:
+            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+        p.wait()
+        p.stdout.close()
+        self.tegrastats_subprocess = None
 
-        if entity == "EMC_FREQ":
-            emc_info = next(tegra_stats_iter)
-            emc_util = emc_info.split("%")[0]
-            emc_freq = str(int(emc_info.split("@")[-1]) * 1000000)
-            tegra_stats_buffer["EMC_UTIL"] = emc_util
-            tegra_stats_buffer["EMC_FREQ"] = emc_freq
+    def _wait_for_shutdown(self):
+        # back off before respawning tegrastats, while still reacting to shutdown
+        return bool(self._selector.select(timeout=self.log_parsing_period))
 
-        if entity == "GR3D_FREQ":
-            gpu_info = next(tegra_stats_iter)
-            gpu_util = gpu_info.split("%")[0]
-            gpu_freq = (
-                gpu_info.split("@")[-1].replace("[", "").replace("]", "").split(",")
+    def _get_tegra_stats(self):
+        """Wait for the next tegrastats line, returns None once shutdown is requested"""
+        while b"\n" not in self._tegrastats_pending:
+            if self.tegrastats_subprocess is None:
+                try:
+                    self._start_tegrastats()
+                except Exception:
+                    if self._wait_for_shutdown():
+                        return None
+                    raise
+            events = self._selector.select(
+                timeout=TEGRASTATS_TIMEOUT_PERIODS * self.log_parsing_period
             )
-            gpu_freq = [str(int(g) * int(1e6)) for g in gpu_freq]
-            tegra_stats_buffer["GPU_UTIL"] = gpu_util
-            tegra_stats_buffer["GPU_FREQ"] = gpu_freq
-
-        if entity in ["NVENC", "NVENC1", "NVDEC", "NVDEC1"]:
-            nv_info = next(tegra_stats_iter)
-            if nv_info != "off":
-                nv_info = str(int(nv_info.split("@")[-1]) * 1000000)
-                tegra_stats_buffer[entity] = nv_info
-
-        if "GPU@" in entity or "gpu@" in entity:
-            gpu_temp = entity.split("@")[1][:-1]
-            tegra_stats_buffer["GPU_TEMP"] = gpu_temp
-
-        if "CPU@" in entity or "cpu@" in entity:
-            cpu_temp = entity.split("@")[1][:-1]
-            tegra_stats_buffer["CPU_TEMP"] = cpu_temp
-        return entity
+            if not events:
+                # tegrastats is alive but silent, respawn it rather than wait forever
+                self._stop_tegrastats()
+                raise Exception("tegrastats stopped producing output !")
+            for key, _ in events:
+                if key.fileobj == self._shutdown_fd:
+                    return None
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    self._stop_tegrastats()
+                    if self._wait_for_shutdown():
+                        return None
+                    raise Exception("tegrastats exited unexpectedly !")
+                self._tegrastats_pending += chunk
+
+        line, _, self._tegrastats_pending = self._tegrastats_pending.partition(b"\n")
+        try:
+            self.tegra_stats = line.decode("utf-8").strip()
+        except Exception:
+            raise Exception("Unable to decode tegrastats output !")
+        return self.tegra_stats
+
+    @staticmethod
+    def _parse_tegra_stats(tegra_stats):
+        tegra_stats_buffer = {}
+        for m in TEGRA_STATS_RE.finditer(tegra_stats):
+            group = m.lastgroup
+            if group == "ram":
+                tegra_stats_buffer["RAM"] = int(m["ram"])
+            elif group == "cpu":
+                # offline cores are reported as "off"
+                tegra_stats_buffer["CPU"] = [
+                    None if e == "off" else int(e.partition("%")[0])
+                    for e in m["cpu"].split(",")
+                ]
+            elif group == "emc_freq":
+                tegra_stats_buffer["EMC_UTIL"] = int(m["emc_util"])
+                tegra_stats_buffer["EMC_FREQ"] = int(m["emc_freq"]) * 1_000_000
+            elif group == "gpu_freq":
+                tegra_stats_buffer["GPU_UTIL"] = int(m["gpu_util"])
+                tegra_stats_buffer["GPU_FREQ"] = [
+                    int(g) * 1_000_000 for g in m["gpu_freq"].split(",")
+                ]
+            elif group == "nvval":
+                tegra_stats_buffer[m["nvkey"]] = int(m["nvval"]) * 1_000_000
+            elif group == "gpu_temp":
+                tegra_stats_buffer["GPU_TEMP"] = float(m["gpu_temp"])
+            elif group == "cpu_temp":
+                tegra_stats_buffer["CPU_TEMP"] = float(m["cpu_temp"])
+        return tegra_stats_buffer
 
     def _produce_gpu_event(self):
         for k, v in self.tegra_stats.items():
-            if k == "GPU_UTIL":
-                self.store_gpu_event(
-                    v,
-                    "GPU_UTIL",
-                    "tegrastats_gpu_util",
-                )
-                self.metric_set["GPU_UTIL"].add("tegrastats_gpu_util")
-            if k == "GPU_FREQ":
-                for gpc_id, gpc_freq in enumerate(v):
-                    self.store_gpu_event(
-                        gpc_freq,
-                        "GPU_FREQ",
-                        "tegrastats_gpu_freq",
-                        **dict(index=gpc_id),
-                    )
-                    self.metric_set["GPU_FREQ"].add(
-                        "tegrastats_gpu_freq_{}".format(gpc_id)
-                    )
-            if k == "GPU_TEMP":
-                self.store_gpu_event(
-                    v,
-                    "GPU_TEMP",
-                    "tegrastats_gpu_temp",
-                )
-                self.metric_set["GPU_TEMP"].add("tegrastats_gpu_temp")
-            if k == "CPU_TEMP":
-                self.store_gpu_event(
-                    v,
-                    "CPU_TEMP",
-                    "tegrastats_cpu_temp",
-                )
-                self.metric_set["CPU_TEMP"].add("tegrastats_cpu_temp")
-            if k == "CPU":
-                for cpu_id, cpu_util in enumerate(v):
-                    if cpu_util != "off":
-                        self.store_gpu_event(
-                            cpu_util,
-                            "CPU",
-                            "tegrastats_cpu_usage",
-                            **dict(index=cpu_id),
-                        )
-                        self.metric_set["CPU"].add(
-                            "tegrastats_cpu_usage_{}".format(cpu_id)
-                        )
-            if k == "RAM":
-                self.store_gpu_event(
-                    v,
-                    "RAM",
-                    "tegrastats_ram_usage",
-                )
-                self.metric_set["RAM"].add("tegrastats_ram_usage")
-            if k == "EMC_FREQ":
-                self.store_gpu_event(
-                    v,
-                    "EMC_FREQ",
-                    "tegrastats_emc_freq",
-                )
-                self.metric_set["EMC_FREQ"].add("tegrastats_emc_freq")
-            if k == "EMC_UTIL":
-                self.store_gpu_event(
-                    v,
-                    "EMC_UTIL",
-                    "tegrastats_emc_util",
-                )
-                self.metric_set["EMC_UTIL"].add("tegrastats_emc_util")
-            if k == "NVENC":
-                self.store_gpu_event(
-                    v,
-                    "NVENC",
-                    "tegrastats_nvenc_freq",
-                )
-                self.metric_set["NVENC"].add("tegrastats_nvenc_freq")
-            if k == "NVENC1":
-                self.store_gpu_event(
-                    v,
-                    "NVENC1",
-                    "tegrastats_nvenc1_freq",
-                )
-                self.metric_set["NVENC1"].add("tegrastats_nvenc1_freq")
-            if k == "NVDEC":
-                self.store_gpu_event(
-                    v,
-                    "NVDEC",
-                    "tegrastats_nvdec_freq",
-                )
-                self.metric_set["NVDEC"].add("tegrastats_nvdec_freq")
-            if k == "NVDEC1":
-                self.store_gpu_event(
-                    v,
-                    "NVDEC1",
-                    "tegrastats_nvdec1_freq",
-                )
-                self.metric_set["NVDEC1"].add("tegrastats_nvdec1_freq")
+            spec = self._DISPATCH.get(k)
+            if spec is None:
+                continue
+            metric_name, metric_key, setter = spec
+            if setter is None:
+                self.store_gpu_event(v, metric_name, metric_key)
+                continue
+            setter = getattr(self.db, setter)
+            for index, value in enumerate(v):
+                if value is not None:
+                    setter(index, value)
 
         for k, v in self.per_process_usage.items():
             self.store_gpu_event(
@@ -272,32 +268,23 @@ class GpuModule:
                 k,
                 "tegrastats_per_process_gpu_mem",
             )
-            self.metric_set[k].add("tegrastats_per_process_gpu_mem")
 
     def _process_gpu_stats_forever(self):
         while True:
-            time.sleep(self.log_parsing_period)
             try:
                 try:
-                    self._get_tegra_stats()
+                    if self._get_tegra_stats() is None:
+                        break
                 except Exception as e:
                     logger.exception("Failed to get tegra stats !!!")
                     raise e
 
-                tegra_stats_iter = iter(self.tegra_stats.split(" "))
-                tegra_stats_buffer = {}
-                entity = None
-                while True:
-                    try:
-                        entity = self._parse_tegra_stats(
-                            tegra_stats_buffer, tegra_stats_iter
-                        )
-                        if entity is None:
-                            break
-                    except Exception as e:
-                        logger.exception("Failed to parse tegra stats")
-                        raise e
-                self.tegra_stats = tegra_stats_buffer
+                try:
+                    self.tegra_stats = self._parse_tegra_stats(self.tegra_stats)
+                except Exception as e:
+                    logger.exception("Failed to parse tegra stats")
+                    raise e
+                self._now_iso = datetime.utcnow().isoformat()
 
                 try:
                     self._get_per_process_gpu_stats()
@@ -317,8 +304,17 @@ class GpuModule:
                     logger.exception("Failed to store gpu event !!!")
                     raise e
 
+                self._set_healthy(True)
             except Exception:
-                self._nullify_gpu_data()
+                # keep the last samples and flag them as unhealthy instead of
+                # reporting zeros
+                self._set_healthy(False)
+
+        self._stop_tegrastats()
+
+    def stop(self):
+        """Ask the worker to exit and terminate tegrastats"""
+        os.eventfd_write(self._shutdown_fd, 1)
 
     def run(self, async_mode=True):
         if async_mode:
@@ -37,7 +37,7 @@ cp -r gpu_module.py db_prometheus.py __main__.py tstats.txt ${INSTALL_DIR}/
 # Install dependencies
 echo "📦 Installing Python dependencies..."
 pip3 install --upgrade pip
-pip3 install "prometheus-client==0.23.1" "pyhumps==3.8.0"
+pip3 install "prometheus-client==0.23.1"
 
 # Create systemd service file
 echo "🧩 Creating systemd service..."
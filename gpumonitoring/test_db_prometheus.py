@@ -0,0 +1,58 @@
+import time
+
+from prometheus_client import generate_latest
+
+from db_prometheus import DataBaseProm
+
+
+def wait_for(db, text):
+    for _ in range(100):
+        metrics = generate_latest(db._registry).decode()
+        if text in metrics:
+            return metrics
+        time.sleep(0.01)
+    raise AssertionError(f"{text} never exported")
+
+
+def test_indexed_series_exported_on_first_sample():
+    db = DataBaseProm(0, num_cpus=4, num_gpcs=2)
+    metrics = generate_latest(db._registry).decode()
+    assert "tegrastats_cpu_usage{" not in metrics
+    assert "tegrastats_gpu_freq{" not in metrics
+
+    db.set_cpu(0, 12)
+    db.set_gpu_freq(1, 305000000)
+    metrics = wait_for(db, 'tegrastats_cpu_usage{index="0",label="CPU"} 12.0')
+    assert 'tegrastats_gpu_freq{index="1",label="GPU_FREQ"} 3.05e+08' in metrics
+    # cores that never reported a value stay absent instead of reading 0
+    assert 'tegrastats_cpu_usage{index="1"' not in metrics
+    assert 'tegrastats_gpu_freq{index="0"' not in metrics
+
+
+def test_default_collectors_exported():
+    db = DataBaseProm(0)
+    metrics = generate_latest(db._registry).decode()
+    assert "python_info{" in metrics
+    assert "python_gc_objects_collected_total" in metrics
+    assert "process_cpu_seconds_total" in metrics
+
+
+def test_per_process_rows_do_not_evict_other_series():
+    db = DataBaseProm(0, num_cpus=12)
+    db.store({"key": "tegrastats_ram_usage", "label": "RAM", "value": 1543})
+    db.set_cpu(0, 12)
+    for i in range(1000):
+        db.store(
+            {
+                "key": "tegrastats_per_process_gpu_mem",
+                "label": f"proc{i}",
+                "value": i,
+            }
+        )
+
+    metrics = wait_for(
+        db, 'tegrastats_per_process_gpu_mem{index="0",label="proc999"} 999.0'
+    )
+    assert 'tegrastats_ram_usage{index="0",label="RAM"} 1543.0' in metrics
+    assert 'tegrastats_cpu_usage{index="0",label="CPU"} 12.0' in metrics
+    assert 'tegrastats_per_process_gpu_mem{index="0",label="proc0"} 0.0' in metrics
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+import gpu_module
+from gpu_module import GpuModule
+
+NANO_LINE = (
+    "RAM 1543/3964MB (lfb 127x4MB) SWAP 0/1982MB (cached 0MB) "
+    "IRAM 0/252kB(lfb 252kB) CPU [12%@1479,3%@1479,off,off] "
+    "EMC_FREQ 4%@1600 GR3D_FREQ 0%@76 APE 25 PLL@27C CPU@29.5C PMIC@100C "
+    "GPU@27C AO@35.5C thermal@28.25C POM_5V_IN 2180/2180 POM_5V_GPU 0/0 "
+    "POM_5V_CPU 458/458"
+)
+
+TX2_LINE = (
+    "RAM 2032/7846MB (lfb 1x4MB) SWAP 0/3923MB (cached 0MB) "
+    "IRAM 0/252kB(lfb 252kB) CPU [2%@345,off,off,1%@345,0%@345,0%@345] "
+    "EMC_FREQ 0%@1866 GR3D_FREQ 0%@114 NVENC 716 NVDEC 1164 APE 150 "
+    "MTS fg 0% bg 0% BCPU@34.5C MCPU@34.5C GPU@32C PLL@34.5C Tboard@29C "
+    "Tdiode@31.25C PMIC@100C thermal@33.1C VDD_IN 1908/1908"
+)
+
+ORIN_LINE = (
+    "10-15-2025 10:00:00 RAM 2345/30536MB (lfb 7x4MB) SWAP 0/15268MB "
+    "(cached 0MB) CPU [1%@729,0%@729,off,off,3%@1190,0%@1190] "
+    "EMC_FREQ 0%@2133 GR3D_FREQ 12%@[305,305] NVENC off NVDEC off NVJPG off "
+    "VIC_FREQ 729 APE 174 CPU@45.5C soc2@44.2C soc0@45.1C gpu@-256C "
+    "tj@45.5C soc1@44.8C VDD_GPU_SOC 2376mW/2376mW VDD_CPU_CV 396mW/396mW"
+)
+
+
+class StubDb:
+    def __init__(self):
+        self.healthy = []
+        self.events = []
+
+    def set_healthy(self, healthy):
+        self.healthy.append(healthy)
+
+    def store(self, msg):
+        self.events.append(msg)
+
+    def set_cpu(self, index, value):
+        self.events.append(
+            {"key": "tegrastats_cpu_usage", "index": index, "value": value}
+        )
+
+    def set_gpu_freq(self, index, value):
+        self.events.append(
+            {"key": "tegrastats_gpu_freq", "index": index, "value": value}
+        )
+
+
+def fake_tegrastats(tmp_path, monkeypatch, script):
+    path = tmp_path / "tegrastats"
+    path.write_text("#!/bin/sh\n" + script)
+    path.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+
+
+def test_parse_nano():
+    assert GpuModule._parse_tegra_stats(NANO_LINE) == {
+        "RAM": 1543,
+        "CPU": [12, 3, None, None],
+        "EMC_UTIL": 4,
+        "EMC_FREQ": 1600 * 1_000_000,
+        "GPU_UTIL": 0,
+        "GPU_FREQ": [76 * 1_000_000],
+        "CPU_TEMP": 29.5,
+        "GPU_TEMP": 27.0,
+    }
+
+
+def test_parse_tx2():
+    stats = GpuModule._parse_tegra_stats(TX2_LINE)
+    assert stats["RAM"] == 2032
+    assert stats["CPU"] == [2, None, None, 1, 0, 0]
+    assert stats["NVENC"] == 716 * 1_000_000
+    assert stats["NVDEC"] == 1164 * 1_000_000
+    assert stats["GPU_TEMP"] == 32.0
+
+
+def test_parse_orin():
+    assert GpuModule._parse_tegra_stats(ORIN_LINE) == {
+        "RAM": 2345,
+        "CPU": [1, 0, None, None, 3, 0],
+        "EMC_UTIL": 0,
+        "EMC_FREQ": 2133 * 1_000_000,
+        "GPU_UTIL": 12,
+        "GPU_FREQ": [305 * 1_000_000, 305 * 1_000_000],
+        "CPU_TEMP": 45.5,
+        "GPU_TEMP": -256.0,
+    }
+
+
+def test_per_process_gpu_stats_larger_than_buffer(tmp_path, monkeypatch):
+    rows = b"".join(b"user  proc%d  %d  %dK\n" % (i, i, i) for i in range(6000))
+    clients = tmp_path / "clients"
+    clients.write_bytes(b"CLIENT PROCESS PID SIZE\n" + rows + b"total 1K\n")
+    monkeypatch.setattr(gpu_module, "NVMAP_CLIENTS", str(clients))
+
+    module = GpuModule(StubDb(), 1)
+    module._get_per_process_gpu_stats()
+    module._parse_per_process_gpu_stats()
+
+    assert len(module.per_process_usage) == 6000
+    assert module.per_process_usage["proc5999"] == 5999
+    assert len(module._nvmap_buf) > 65536
+
+
+def test_silent_tegrastats_is_respawned(tmp_path, monkeypatch):
+    fake_tegrastats(tmp_path, monkeypatch, "exec sleep 30\n")
+    module = GpuModule(StubDb(), 0.05)
+
+    with pytest.raises(Exception, match="stopped producing output"):
+        module._get_tegra_stats()
+    assert module.tegrastats_subprocess is None
+
+
+def test_health_flips_without_zeroing_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(gpu_module, "NVMAP_CLIENTS", str(tmp_path / "missing"))
+    db = StubDb()
+    module = GpuModule(db, 1)
+
+    def fail():
+        raise Exception("tegrastats exited unexpectedly !")
+
+    def succeed():
+        module.tegra_stats = NANO_LINE
+        return module.tegra_stats
+
+    # None ends the worker loop like a shutdown request
+    sources = iter([fail, succeed, fail, lambda: None])
+    monkeypatch.setattr(module, "_get_tegra_stats", lambda: next(sources)())
+    module._process_gpu_stats_forever()
+
+    assert db.healthy == [False, True, False]
+    values = {(e["key"], e.get("index")): e["value"] for e in db.events}
+    assert values[("tegrastats_ram_usage", None)] == 1543
+    assert values[("tegrastats_cpu_usage", 0)] == 12
+    assert values[("tegrastats_gpu_temp", None)] == 27.0
+    # the failed cycle after the good one did not overwrite anything
+    assert len(db.events) == len(values)